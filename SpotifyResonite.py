@@ -1,38 +1,32 @@
-from pip._internal import main as pipmain
 import asyncio
+import functools
+import logging
+import operator
 import os
-from datetime import datetime
+import time
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+import aiohttp
 import spotipy
-from spotipy.oauth2 import SpotifyOAuth
+from spotipy.oauth2 import SpotifyOAuth, SpotifyOauthError
 import yaml
-import requests
+try:
+    from yaml import CSafeLoader as _YLoader
+except ImportError:
+    from yaml import SafeLoader as _YLoader
 import websockets
 
 
-def install_and_import(package, import_name=None):
-    try:
-        if import_name:
-            __import__(import_name)
-        else:
-            __import__(package)
-    except ImportError:
-        pipmain(['install', package])
-        if import_name:
-            __import__(import_name)
-        else:
-            __import__(package)
-
-install_and_import('websockets')
-install_and_import('spotipy')
-install_and_import('pyyaml', 'yaml')
-
-def get_time():
-    return datetime.now().strftime("[%d/%m/%Y %H:%M:%S]:")
+_GET_NAME = operator.itemgetter('name')
+
+logging.basicConfig(format="%(asctime)s %(message)s", datefmt="[%d/%m/%Y %H:%M:%S]:")
+logger = logging.getLogger("SpotifyResonite")
+logger.setLevel(logging.INFO)
 
 def load_config():
     file_path = os.path.join(os.getcwd(), "config.yml")
     with open(file_path, "r") as ymlfile:
-        return yaml.safe_load(ymlfile)
+        return yaml.load(ymlfile, Loader=_YLoader)
 
 cfg = load_config()
 
@@ -45,68 +39,276 @@ sp = spotipy.Spotify(auth_manager=SpotifyOAuth(
     open_browser=True))
 
 test = sp.devices()
-print(get_time(), "Connected to Spotify successfully!")
+logger.info("Connected to Spotify successfully!")
+
+# spotipy is blocking, so its calls run here instead of on the event loop
+_sp_executor = ThreadPoolExecutor(max_workers=4)
+
+async def _sp(fn, *args, **kwargs):
+    return await asyncio.get_running_loop().run_in_executor(_sp_executor, functools.partial(fn, *args, **kwargs))
+
+_session = None
+
+def _get_session():
+    global _session
+    if _session is None or _session.closed:
+        _session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=8, ttl_dns_cache=300))
+    return _session
+
+class SpotifyAsyncLite:
+    """aiohttp client for the few Web API endpoints the server polls.
+
+    Keeps connections to api.spotify.com alive between polls and only falls
+    back to spotipy's auth manager when the access token has expired.
+    """
+
+    API_URL = "https://api.spotify.com/v1/"
+    TIMEOUT = aiohttp.ClientTimeout(total=5)
+    # As spotipy did: retry 429/5xx a few times, waiting out a short Retry-After
+    RETRIES = 3
+    BACKOFF = 0.3
+    MAX_RETRY_AFTER = 5
+
+    def __init__(self, auth_manager):
+        self.auth_manager = auth_manager
+        self._token_info = None
+        self._token_lock = asyncio.Lock()
+
+    def _token_expired(self):
+        return self._token_info is None or self.auth_manager.is_token_expired(self._token_info)
+
+    async def _token(self):
+        if self._token_expired():
+            # Only the first caller refreshes; the rest wait and reuse its token
+            async with self._token_lock:
+                if self._token_expired():
+                    token_info = await _sp(lambda: self.auth_manager.validate_token(self.auth_manager.get_cached_token()))
+                    if token_info is None:
+                        raise SpotifyOauthError("No valid Spotify token; restart the server to log in again")
+                    self._token_info = token_info
+        return self._token_info['access_token']
+
+    def _retry_delay(self, response, attempt):
+        if attempt >= self.RETRIES or not (response.status == 429 or response.status >= 500):
+            return None
+        delay = self.BACKOFF * 2 ** attempt
+        if response.status == 429:
+            try:
+                delay = float(response.headers.get("Retry-After", delay))
+            except ValueError:
+                pass
+        return delay if delay <= self.MAX_RETRY_AFTER else None
+
+    async def _request(self, method, path, params=None, payload=None):
+        for attempt in range(self.RETRIES + 1):
+            headers = {"Authorization": f"Bearer {await self._token()}"}
+            async with _get_session().request(method, self.API_URL + path, headers=headers, params=params, json=payload, timeout=self.TIMEOUT) as response:
+                delay = self._retry_delay(response, attempt)
+                if delay is None:
+                    if response.status >= 400:
+                        raise spotipy.SpotifyException(response.status, -1, f"{response.url}: {await response.text()}")
+                    if response.status == 204:
+                        return None
+                    return await response.json()
+            await asyncio.sleep(delay)
+
+    async def current_playback(self):
+        return await self._request("GET", "me/player")
+
+    async def current_user_playlists(self, limit=50, offset=0):
+        return await self._request("GET", "me/playlists", params={"limit": limit, "offset": offset})
+
+spotify = SpotifyAsyncLite(sp.auth_manager)
+
+_CANVAS_CACHE_MAX = 512
+_canvas_cache = OrderedDict()
+
+_CANVAS_TIMEOUT = aiohttp.ClientTimeout(total=5)
+
+async def fetch_canvas(track_uri):
+    url = f"https://spotify-canvas-api-weld.vercel.app/spotify?id={track_uri}"
+    async with _get_session().get(url, timeout=_CANVAS_TIMEOUT) as response:
+        response.raise_for_status()
+        return await response.text()
+
+async def get_canvas(track_uri):
+    if track_uri in _canvas_cache:
+        _canvas_cache.move_to_end(track_uri)
+        return _canvas_cache[track_uri]
+    canvas = await fetch_canvas(track_uri)
+    _canvas_cache[track_uri] = canvas
+    if len(_canvas_cache) > _CANVAS_CACHE_MAX:
+        _canvas_cache.popitem(last=False)
+    return canvas
 
-async def server(websocket, path):
-    print(get_time(), 'Client connected!')
+# Latest current_playback() result, shared by the monitor and all clients
+_playback_cache = None
+_playback_ts = 0.0
+_playback_updated = asyncio.Event()
+
+async def get_playback(max_age=0.0):
+    global _playback_cache, _playback_ts
+    if time.monotonic() - _playback_ts >= max_age:
+        _playback_cache = await spotify.current_playback()
+        _playback_ts = time.monotonic()
+    return _playback_cache
+
+async def server(websocket):
+    logger.info('Client connected!')
+    outq = asyncio.Queue(maxsize=256)
+    writer = asyncio.create_task(writer_loop(websocket, outq))
+    pusher = asyncio.create_task(push_playback(outq))
     try:
         async for message in websocket:
-            process_message(message, websocket)
-    except Exception as e:
-        print(get_time(), "Error:", e)
+            try:
+                await process_message(message, outq)
+            except Exception:
+                logger.exception("Error handling %r", message)
+    except Exception:
+        logger.exception("Connection error")
     finally:
-        print(get_time(), "Client disconnected")
-
-async def process_message(message, websocket):
-    command, *args = message.split(";")
-    if command == 'current':
-        await handle_current_playback(websocket)
-    elif command == 'playlists':
-        await send_playlists(websocket)
-
-async def handle_current_playback(websocket):
-    result = sp.current_playback()
-    if result:
-        artist_names = ', '.join(artist['name'] for artist in result['item']['artists'])
+        writer.cancel()
+        pusher.cancel()
+        await asyncio.gather(writer, pusher, return_exceptions=True)
+        logger.info("Client disconnected")
+
+async def writer_loop(websocket, outq):
+    # Queue entries are (kind, frame). When several are waiting, a frame is
+    # dropped if the next one is of the same kind and so supersedes it.
+    while True:
+        batch = [await outq.get()]
+        while True:
+            try:
+                batch.append(outq.get_nowait())
+            except asyncio.QueueEmpty:
+                break
+        try:
+            for (kind, frame), following in zip(batch, batch[1:] + [None]):
+                if following is None or following[0] != kind:
+                    await websocket.send(frame)
+        except websockets.ConnectionClosed:
+            return
+
+async def push_playback(outq):
+    while True:
+        await _playback_updated.wait()
+        try:
+            # The monitor has just stored this poll, so no extra API call
+            await outq.put(('current', current_frame(_playback_cache)))
+        except Exception:
+            logger.exception("Error pushing playback")
+
+async def process_message(message, outq):
+    command = message.partition(";")[0]
+    handler = _HANDLERS.get(command)
+    if handler is not None:
+        await handler(outq)
+
+# Field separator of the text protocol the Resonite client parses
+SEP_FIELD = "\t"
+# Sent in place of an image URL for playlists without artwork
+_NO_IMAGE = "No Image"
+
+# The !current frame only depends on the track, so it is rebuilt on track change
+_current_frame_key = None
+_current_frame = None
+
+def current_frame(result):
+    global _current_frame_key, _current_frame
+    # Ads and podcast episodes come back with no item
+    if not result or not result.get('item'):
+        return "!currentNone"
+    if result['item']['uri'] != _current_frame_key:
+        artist_names = ', '.join(map(_GET_NAME, result['item']['artists']))
         track_name = result['item']['name']
-        await websocket.send(f"!current{artist_names}\t{track_name}")
-    else:
-        await websocket.send("!currentNone")
+        _current_frame = f"!current{artist_names}{SEP_FIELD}{track_name}"
+        _current_frame_key = result['item']['uri']
+    return _current_frame
 
-async def send_playlists(websocket):
-    playlists = sp.current_user_playlists()
-    formatted_playlists = [f"{playlist['name']}\t{playlist['images'][0]['url'] if playlist['images'] else 'No Image'}" for playlist in playlists['items']]
-    await websocket.send("!playlists" + "\t".join(formatted_playlists))
+async def handle_current_playback(outq):
+    await outq.put(('current', current_frame(await get_playback(max_age=0.5))))
+
+async def send_playlists(outq):
+    playlists = await spotify.current_user_playlists()
+    formatted_playlists = [f"{playlist['name']}{SEP_FIELD}{playlist['images'][0]['url'] if playlist['images'] else _NO_IMAGE}" for playlist in playlists['items']]
+    await outq.put(('playlists', "!playlists" + SEP_FIELD.join(formatted_playlists)))
+
+_HANDLERS = {
+    'current': handle_current_playback,
+    'playlists': send_playlists,
+}
+
+# Seconds between polls: 1 while playing, 5 when paused or on an ad/podcast,
+# 15 with no active device, doubling up to 30 after an error
+_poll_interval = 1.0
+
+# One fixed-period timer for all periodic work; subscribers await _tick.wait()
+# and count ticks to run at their own interval
+_TICK_PERIOD = 1.0
+_tick = asyncio.Event()
+
+async def ticker():
+    while True:
+        _tick.set()
+        _tick.clear()
+        await asyncio.sleep(_TICK_PERIOD)
+
+async def log_track(result, status):
+    # The canvas only goes to the log, so its failures never reach the poll backoff
+    if not logger.isEnabledFor(logging.INFO):
+        return
+    artist_names = ', '.join(map(_GET_NAME, result['item']['artists']))
+    current_track = f"{artist_names} - {result['item']['name']}"
+    try:
+        canvas = await get_canvas(result['item']['uri'])
+    except Exception as e:
+        canvas = f"unavailable ({e})"
+    logger.info(f"Status: {status}, Track: {current_track}, Canvas: {canvas}")
 
 async def monitor_spotify_playback():
+    global _poll_interval
     last_status = None
     last_track = None
+    ticks_left = 0
     while True:
-        result = sp.current_playback()
-        if result:
-            is_playing = result['is_playing']
-            current_status = 'Playing' if is_playing else 'Paused'
-            artist_names = ', '.join(artist['name'] for artist in result['item']['artists'])
-            track_name = result['item']['name']
-            current_track = f"{artist_names} - {track_name}"
-            canvas = f"https://spotify-canvas-api-weld.vercel.app/spotify?id={result['item']['uri']}"
-
-            if current_status != last_status or current_track != last_track:
-                url = f"{canvas}"
-                response = requests.get(url)
-                print(f"{get_time()} Status: {current_status}, Track: {current_track}, Canvas: {response.text}")
-                last_status = current_status
-                last_track = current_track
-        else:
-            if last_status is not None or last_track is not None:
-                print(f"{get_time()} No playback found or Spotify is not active.")
-                last_status = None
-                last_track = None
+        await _tick.wait()
+        ticks_left -= 1
+        if ticks_left > 0:
+            continue
+        try:
+            result = await get_playback()
+            # Ads and podcast episodes come back with no item; treat them as no track
+            has_track = bool(result and result.get('item'))
+            if has_track:
+                is_playing = result['is_playing']
+                current_status = 'Playing' if is_playing else 'Paused'
+                track_uri = result['item']['uri']
+
+                if current_status != last_status or track_uri != last_track:
+                    # !current only carries the track, so play/pause alone isn't pushed
+                    if track_uri != last_track:
+                        _playback_updated.set()
+                        _playback_updated.clear()
+                    last_status = current_status
+                    last_track = track_uri
+                    await log_track(result, current_status)
+            else:
+                if last_status is not None or last_track is not None:
+                    logger.info("No playback found or Spotify is not active.")
+                    last_status = None
+                    last_track = None
+                    _playback_updated.set()
+                    _playback_updated.clear()
+            _poll_interval = 1.0 if has_track and result['is_playing'] else 5.0 if result else 15.0
+        except Exception:
+            logger.exception("Error polling Spotify playback")
+            _poll_interval = min(_poll_interval * 2, 30.0)
+        ticks_left = round(_poll_interval / _TICK_PERIOD)
 
 async def main():
     server_task = websockets.serve(server, "localhost", 8765)
     monitor_task = monitor_spotify_playback()
-    await asyncio.gather(server_task, monitor_task)
+    await asyncio.gather(server_task, monitor_task, ticker())
 
 if __name__ == "__main__":
     asyncio.run(main())
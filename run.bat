@@ -1,5 +1,4 @@
 @echo off
-py -m pip install spotipy
-py -m pip install websockets
+py -m pip install -r requirements.txt
 py SpotifyResonite.py
 pause